@@ -18,12 +18,80 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import base64
 import datetime
+import io
 import plistlib
 import pprint
 import os
 import json
+import pickle
 import sys
+import tempfile
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    ProcessPoolExecutor = None
+
+try:
+    import biplist
+except ImportError:
+    biplist = None
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PLIST_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Parsed AlbumData is cached next to AlbumData.xml in a file with this suffix
+CACHE_SUFFIX = '.cache.pkl'
+# Bump whenever the layout of the cached data changes
+_CACHE_VERSION = 3
+
+# Without numpy, convert_image_dates spreads at least this many images over
+# a process pool. Below it the pool start up costs more than it saves.
+PARALLEL_THRESHOLD = 5000
+
+# Timer intervals in AlbumData.xml count seconds from the mac epoch
+_MAC_EPOCH = datetime.datetime(2001, 1, 1)
+
+# Extensions of binary plist siblings of AlbumData.xml, in order of preference
+BINARY_ALBUMDATA_EXTENSIONS = ('.plist', '.binary')
+
+# (AlbumData.xml key, converted key) for each mac epoch date field
+_DATE_FIELDS = (('ModDateAsTimerInterval', 'ModDate'),
+                ('DateAsTimerInterval', 'Date'),
+                ('MetaModDateAsTimerInterval', 'MetaModDate'),
+                ('DateAsTimerIntervalGMT', 'DateGMT'))
+_RENAME = dict(_DATE_FIELDS)
+
+# Elements converted as a whole once they end, <plist> acts like an array
+_PLIST_CONTAINERS = ('dict', 'array', 'plist')
+
+# Converters for the plist scalar elements, keyed by tag name
+_PLIST_SCALARS = {
+    'string': lambda text: text or '',
+    'integer': int,
+    'real': float,
+    'date': lambda text: datetime.datetime.strptime(text, PLIST_DATE_FORMAT),
+    'data': lambda text: base64.b64decode(text or ''),
+    'true': lambda text: True,
+    'false': lambda text: False,
+}
 
 
 def convert_timer_interval(seconds):
@@ -38,12 +106,14 @@ def convert_timer_interval(seconds):
     """
     # Referenced:
     # http://www.tablix.org/~avian/blog/archives/2011/02/to_mac_and_back_again/
-    return datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=seconds)
+    return _MAC_EPOCH + datetime.timedelta(seconds=seconds)
 
 
 def timerinterval_to_datetime(data):
     """Convert all fields with AsTimerInterval into python datetimes.
 
+    A new dict is returned, data itself is left untouched.
+
     Args:
         data (dict): A dictionary that should look something like this::
 
@@ -77,58 +147,354 @@ def timerinterval_to_datetime(data):
                            'ThumbPath': 'local_filepath_to_thumb'}, ...}
 
     """
-    for key in data:
-        if 'AsTimerInterval' in key:
-            new_key = key.replace('AsTimerInterval', '')
-            data[new_key] = convert_timer_interval(data[key])
-            del data[key]
-    return data
+    converted = {}
+    for key, value in data.items():
+        if key in _RENAME:
+            converted[_RENAME[key]] = convert_timer_interval(value)
+        else:
+            converted[key] = value
+    return converted
+
+
+def _seconds_to_micros(seconds):
+    """Round float seconds to whole microseconds like datetime.timedelta
+
+    timedelta rounds the fractional part of the seconds on its own, which
+    gives a different result than rounding seconds * 1e6 for some values.
+
+    Args:
+        seconds (numpy.ndarray): float64 seconds
+
+    Returns:
+        numpy.ndarray of int64 microseconds
+
+    """
+    fraction, whole = numpy.modf(seconds)
+    return whole.astype(numpy.int64) * 1000000 + \
+        numpy.rint(fraction * 1e6).astype(numpy.int64)
+
+
+def _convert_chunk(items):
+    """Run timerinterval_to_datetime over (image_id, image) pairs
+
+    Args:
+        items (list): (image_id, image dict) tuples
+
+    Returns:
+        dict. image_id to converted image dict
+
+    """
+    convert = timerinterval_to_datetime
+    return {image_id: convert(photo) for image_id, photo in items}
+
+
+def convert_image_dates(images):
+    """Convert the AsTimerInterval fields of every image into datetimes
+
+    When numpy is available all of the timer intervals are converted in one
+    vectorized operation, otherwise timerinterval_to_datetime is called for
+    each image, spread over a process pool for PARALLEL_THRESHOLD or more
+    images when there is more than one CPU.
+
+    Args:
+        images (dict): image_id to image dict, as found in the
+            'Master Image List' of AlbumData.xml
+
+    Returns:
+        dict. image_id to image dict with datetime fields, see
+        timerinterval_to_datetime
+
+    """
+    if numpy is None:
+        items = list(images.items())
+        workers = os.cpu_count() or 1
+        if ProcessPoolExecutor is not None and workers > 1 and \
+                len(items) >= PARALLEL_THRESHOLD:
+            size = -(-len(items) // workers)
+            chunks = [items[i:i + size] for i in range(0, len(items), size)]
+            try:
+                with ProcessPoolExecutor(workers) as executor:
+                    converted = {}
+                    for chunk in executor.map(_convert_chunk, chunks):
+                        converted.update(chunk)
+                    return converted
+            except (OSError, NotImplementedError, BrokenProcessPool):
+                # No working multiprocessing here, convert serially
+                pass
+        return _convert_chunk(items)
+
+    # One iterator of converted datetimes per field, in images order
+    dates = {}
+    for old_key in _RENAME:
+        seconds = numpy.asarray([photo[old_key] for photo in images.values()
+                                 if old_key in photo], dtype=numpy.float64)
+        field_dates = numpy.datetime64(_MAC_EPOCH, 'us') + \
+            _seconds_to_micros(seconds).astype('timedelta64[us]')
+        dates[old_key] = iter(field_dates.tolist())
+
+    converted = {}
+    for image_id, photo in images.items():
+        new_photo = {}
+        for key, value in photo.items():
+            if key in dates:
+                new_photo[_RENAME[key]] = next(dates[key])
+            else:
+                new_photo[key] = value
+        converted[image_id] = new_photo
+    return converted
+
+
+def _plist_scalar(elem):
+    """Convert a <key> or scalar plist element to python
+
+    Args:
+        elem (lxml.etree._Element): A key, string, integer, ... element
+
+    Returns:
+        The key or scalar value
+
+    """
+    if elem.tag == 'key':
+        # The same few keys repeat for every image, share one string each
+        return sys.intern(elem.text or '')
+    return _PLIST_SCALARS[elem.tag](elem.text)
+
+
+def _read_plist_lxml(path):
+    """Parse an XML plist with lxml's iterparse
+
+    Each dict and array is converted as soon as its end tag is parsed.
+    The converted value, together with the keys and scalars in front of
+    it, is then moved out of the element tree, so memory stays flat even
+    for very large AlbumData.xml files.
+
+    Args:
+        path (str): Path to the XML plist
+
+    Returns:
+        The top level plist object (usually a dict)
+
+    """
+    # [element, values] for each open container that some children have
+    # already been converted and removed from
+    partial = []
+    with io.open(path, 'rb') as plist_file:
+        for _, elem in etree.iterparse(plist_file, events=('end',),
+                                       tag=_PLIST_CONTAINERS,
+                                       huge_tree=True, resolve_entities=False,
+                                       no_network=True, remove_comments=True,
+                                       remove_pis=True):
+            if partial and partial[-1][0] is elem:
+                values = partial.pop()[1]
+            else:
+                values = []
+            values.extend(_plist_scalar(child) for child in elem)
+            if elem.tag == 'dict':
+                # Children alternate <key>, value, <key>, value, ...
+                pairs = iter(values)
+                value = dict(zip(pairs, pairs))
+            else:
+                value = values
+
+            parent = elem.getparent()
+            if parent is None:
+                # <plist> holds the top level object
+                return value[0] if value else None
+            if not partial or partial[-1][0] is not parent:
+                partial.append([parent, []])
+            parent_values = partial[-1][1]
+            count = 0
+            for child in parent:
+                if child is elem:
+                    break
+                parent_values.append(_plist_scalar(child))
+                count += 1
+            parent_values.append(value)
+            del parent[:count + 1]
+    return None
+
+
+def read_plist(path):
+    """Read a plist, using lxml when it is installed
+
+    Args:
+        path (str): Path to the XML plist
+
+    Returns:
+        The top level plist object (usually a dict)
+
+    """
+    if etree is not None:
+        return _read_plist_lxml(path)
+    with open(path, 'rb') as plist_file:
+        return plistlib.load(plist_file)
+
+
+def find_binary_albumdata(albumdata_fullpath):
+    """Look for a binary plist copy of AlbumData.xml in the same directory
+
+    A binary copy older than AlbumData.xml is stale and is ignored.
+
+    Args:
+        albumdata_fullpath (str): Full path to AlbumData.xml
+
+    Returns:
+        str. Path of the binary plist or None if there isn't a current one
+
+    """
+    try:
+        xml_mtime = os.path.getmtime(albumdata_fullpath)
+    except OSError:
+        xml_mtime = None
+    base = os.path.splitext(albumdata_fullpath)[0]
+    for extension in BINARY_ALBUMDATA_EXTENSIONS:
+        path = base + extension
+        if path == albumdata_fullpath or not os.path.isfile(path):
+            continue
+        if xml_mtime is None or os.path.getmtime(path) >= xml_mtime:
+            return path
+    return None
+
+
+def _cache_key(path):
+    """Key identifying the current contents of path for the pickle cache
+
+    Args:
+        path (str): Path of the plist that was parsed
+
+    Returns:
+        tuple. Or None if path can't be stat'd
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (_CACHE_VERSION, path, stat.st_mtime, stat.st_size)
 
 
 class IPhoto(object):
     """ OS X iPhoto support """
     def __init__(self, iphoto_library='~/Pictures/iPhoto Library.photolibrary',
-                 albumdata_filename='AlbumData.xml'):
+                 albumdata_filename='AlbumData.xml', use_cache=True):
         """ Open AlbumData.xml and generate internal data
 
         Args:
             iphoto_library (str): Path to the iPhoto Library.photolibrary dir
             albumdata_filename (str): filename of AlbumData.xml
+            use_cache (bool): if True load from and save to a pickle cache
+                of the parsed AlbumData.xml
 
         """
-        if iphoto_library.startswith("~/"):
-            iphoto_library = os.path.join(os.environ["HOME"],
-                                          iphoto_library[2:])
+        iphoto_library = os.path.expanduser(iphoto_library)
         self._albumdata_fullpath = os.path.join(iphoto_library,
                                                 albumdata_filename)
-        self._images = {}
-        self._albums = {}
+        self._cache_path = self._albumdata_fullpath + CACHE_SUFFIX
+
+        # Binary plists are much cheaper to deserialize than XML
+        binary_path = None
+        if biplist is not None:
+            binary_path = find_binary_albumdata(self._albumdata_fullpath)
+
+        cache_key = None
+        if use_cache:
+            cache_key = _cache_key(binary_path or self._albumdata_fullpath)
+        if cache_key is None or not self._load_cache(cache_key):
+            self._load_database(binary_path)
+            if cache_key is not None:
+                self._save_cache(cache_key)
+
+        # Image dates are only converted once photos() asks for them,
+        # self._images caches those. It is created with every image_id
+        # (mapped to None) so filling it in never has to resize the dict.
+        self._images = dict.fromkeys(self._raw_images)
+        # OriginalPath seems to be set on "RAW" photos
+        self._raw_ids = frozenset(image_id for image_id, image
+                                  in self._raw_images.items()
+                                  if 'OriginalPath' in image)
+
+    def _load_database(self, binary_path=None):
+        """ Parse AlbumData into raw images and albums
+
+        Args:
+            binary_path (str): binary plist to read instead of AlbumData.xml
 
-        database = plistlib.readPlist(self._albumdata_fullpath)
+        """
+        if binary_path:
+            database = biplist.readPlist(binary_path)
+        else:
+            database = read_plist(self._albumdata_fullpath)
 
         # All images (and movies) are referenced here:
-        master_image_list = database['Master Image List']
-        for image_id in master_image_list:
-            self._images[image_id] = \
-                timerinterval_to_datetime(master_image_list[image_id])
+        self._raw_images = database['Master Image List']
 
         # { AlbumName: { 'photos': ["image_id", "image_id"], }
-        for album in database['List of Albums']:
-            if album['PhotoCount'] != len(album['KeyList']):
-                raise ValueError("Error: PhotoCount != length KeyList array")
-            self._albums[album['AlbumName']] = {'photos': album['KeyList'],
-                                                'count': album['PhotoCount'],
-                                                'id': album['AlbumId']}
+        albums = database['List of Albums']
+        if any(album['PhotoCount'] != len(album['KeyList'])
+               for album in albums):
+            raise ValueError("Error: PhotoCount != length KeyList array")
+        self._albums = {album['AlbumName']: {'photos': album['KeyList'],
+                                             'id': album['AlbumId']}
+                        for album in albums}
+
+    def _load_cache(self, cache_key):
+        """ Load raw images and albums from the pickle cache
+
+        Args:
+            cache_key (tuple): Expected key, see _cache_key
+
+        Returns:
+            bool. True if the cache was loaded, False if it is missing,
+            unreadable or stale
+
+        """
+        try:
+            with open(self._cache_path, 'rb') as cache_file:
+                key, raw_images, albums = pickle.load(cache_file)
+        # Unpickling can raise nearly anything, e.g. ImportError when the
+        # cache references a module that has since been uninstalled
+        except Exception:  # pylint: disable=W0703
+            return False
+        if key != cache_key:
+            return False
+        self._raw_images = raw_images
+        self._albums = albums
+        return True
+
+    def _save_cache(self, cache_key):
+        """ Save raw images and albums to the pickle cache, ignoring failures
+
+        The pickle is written to a temporary file which then replaces the
+        cache, so readers never see a partially written cache.
+
+        Args:
+            cache_key (tuple): Key to store with the data, see _cache_key
+
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self._cache_path), suffix=CACHE_SUFFIX)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump((cache_key, self._raw_images, self._albums),
+                            cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def albums(self):
-        """ Generator for album names
+        """ Album names
 
         Returns:
-            generator of str for each album name
+            iterable view of str for each album name
 
         """
-        for album in self._albums:
-            yield album
+        return self._albums.keys()
 
     def album_data(self, album_name):
         """ Album data for album_name
@@ -139,11 +505,23 @@ class IPhoto(object):
         Returns:
             dict. With the album details::
 
-                {'photos': [ image_id,...], 'count': 1234, 'id': 2}
+                {'photos': [ image_id,...], 'id': 2}
 
         """
         return self._albums[album_name]
 
+    def photo_count(self, album_name):
+        """ Number of photos in album_name
+
+        Args:
+            album_name(str): The actual album name
+
+        Returns:
+            int. PhotoCount of the album
+
+        """
+        return len(self._albums[album_name]['photos'])
+
     def photos(self, album, include_raw_photos=False):
         """ Generator for photos given an album_name:
 
@@ -168,11 +546,19 @@ class IPhoto(object):
                      'ThumbPath': 'local_filepath_to_thumb'}
 
         """
-        for photo in self.album_data(album)['photos']:
-            # OriginalPath seems to be set on "RAW" photos
-            if "OriginalPath" in photo and include_raw_photos is False:
+        photo_ids = self._albums[album]['photos']
+        images = self._images
+        raw_ids = self._raw_ids
+        # Convert the dates of the photos that will be yielded in one batch
+        missing = {photo: self._raw_images[photo] for photo in photo_ids
+                   if images[photo] is None and
+                   (include_raw_photos or photo not in raw_ids)}
+        if missing:
+            images.update(convert_image_dates(missing))
+        for photo in photo_ids:
+            if include_raw_photos is False and photo in raw_ids:
                 continue
-            yield self._images[photo]
+            yield images[photo]
 
 
 class DatetimeEncoder(json.JSONEncoder):
@@ -198,6 +584,67 @@ class DatetimeEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, obj)
 
 
+class _TextWriter(object):
+    """ Binary file interface for a text only stream (no .buffer) """
+    def __init__(self, stream):
+        """ Wrap stream
+
+        Args:
+            stream (file): Text stream to write to
+
+        """
+        self._stream = stream
+
+    def write(self, data):
+        """ Decode UTF-8 bytes and write them to the text stream
+
+        Args:
+            data (bytes): UTF-8 encoded text, never split inside a character
+
+        """
+        self._stream.write(data.decode('utf-8'))
+
+
+def write_photos_json(iphoto, album_names, output):
+    """ Stream the photos of each album to output as a JSON object
+
+    Photos are encoded one at a time as they come out of IPhoto.photos() so
+    an album never has to be held in memory as a whole. Without orjson the
+    result matches json.dump({album_name: [photo, ...], ...}, output,
+    indent=2, cls=DatetimeEncoder). orjson is used to encode the photos
+    when it is installed, it handles datetimes natively but writes
+    non-ASCII characters as raw UTF-8 and NaN as null.
+
+    Args:
+        iphoto (IPhoto): Library to read the photos from
+        album_names (list): album names, these become the keys
+        output (file): Binary file to write the UTF-8 encoded JSON to
+
+    """
+    output.write(b'{')
+    seen = set()
+    for album_name in album_names:
+        if album_name in seen:
+            continue
+        if seen:
+            output.write(b',')
+        seen.add(album_name)
+        output.write('\n  {0}: ['.format(json.dumps(album_name)).encode())
+        empty = True
+        for photo in iphoto.photos(album_name):
+            if not empty:
+                output.write(b',')
+            empty = False
+            if orjson is not None:
+                photo_json = orjson.dumps(photo, option=orjson.OPT_INDENT_2)
+            else:
+                photo_json = json.dumps(photo, indent=2,
+                                        cls=DatetimeEncoder).encode()
+            output.write(b'\n    ' + photo_json.replace(b'\n', b'\n    '))
+        output.write(b']' if empty else b'\n  ]')
+    output.write(b'\n}' if seen else b'}')
+
+
 def main():
     """ Main entry point, if called directly """
     parser = argparse.ArgumentParser(description="iPhoto library")
@@ -212,10 +659,10 @@ def main():
     iphoto = IPhoto()
     if args.album:
         if args.format == 'json':
-            output = {}
-            for album_name in args.album:
-                output[album_name] = list(iphoto.photos(album_name))
-            json.dump(output, sys.stdout, indent=2, cls=DatetimeEncoder)
+            output = getattr(sys.stdout, 'buffer', None)
+            if output is None:
+                output = _TextWriter(sys.stdout)
+            write_photos_json(iphoto, args.album, output)
         elif args.format == 'text':
             pprinter = pprint.PrettyPrinter(indent=2)
             for album in args.album:
@@ -224,7 +671,7 @@ def main():
                           format(album, photo['GUID'])))
                     pprinter.pprint(photo)
     elif args.list:
-        output = sorted(list(iphoto.albums()))
+        output = sorted(iphoto.albums())
         if args.format == 'json':
             json.dump(output, sys.stdout, indent=2)
         elif args.format == 'text':
@@ -15,8 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from ..iphoto import IPhoto, plistlib, convert_timer_interval, \
-    timerinterval_to_datetime
+from .. import iphoto
+from ..iphoto import IPhoto, convert_timer_interval, \
+    timerinterval_to_datetime, read_plist, convert_image_dates, \
+    write_photos_json, DatetimeEncoder, find_binary_albumdata
+import io
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from datetime import datetime
@@ -28,6 +35,8 @@ MOCK_DATABASE = {'List of Albums': [{'AlbumId': '1',
                                      'PhotoCount': 2}],
                  'Master Image List': {'1': {'Caption': 'A normal caption',
                                              'Comment': 'no comment',
+                                             'DateAsTimerInterval':
+                                             409106772.65649,
                                              'GUID': '23413434341234123411234',
                                              'ImagePath': 'b/joke.jpg',
                                              'MediaType': 'Image',
@@ -47,7 +56,7 @@ class TestIPhoto(unittest.TestCase):
     """Unit testing for IPhoto"""
 
     # pylint: disable=W0221
-    @patch.object(plistlib, 'readPlist')
+    @patch.object(iphoto, 'read_plist')
     def setUp(self, mock):
         """ initialize self.iphoto with MOCK_DATABASE
 
@@ -56,7 +65,19 @@ class TestIPhoto(unittest.TestCase):
 
         """
         mock.return_value = MOCK_DATABASE
-        self.iphoto = IPhoto()
+        # Never touch the cache of a real library on this machine
+        self.iphoto = IPhoto(use_cache=False)
+
+    def mkdtemp(self):
+        """ Temporary directory that is removed when the test is done
+
+        Returns:
+            str. path of the directory
+
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return tmpdir
 
     def test_convert_timer_interval(self):
         """ Unit testing for convert_timer_interval """
@@ -75,6 +96,7 @@ class TestIPhoto(unittest.TestCase):
                     'ModDate': datetime(2012, 12, 23, 0, 9, 13)}
         self.assertDictEqual(expected,
                              timerinterval_to_datetime(sample))
+        self.assertIn('DateAsTimerInterval', sample)
 
     def test_photos(self):
         """ Test database """
@@ -91,7 +113,192 @@ class TestIPhoto(unittest.TestCase):
     def test_album_data(self):
         """ Test album_data """
         album_data = {'photos': MOCK_DATABASE['List of Albums'][0]['KeyList'],
-                      'count': MOCK_DATABASE['List of Albums'][0]
-                      ['PhotoCount'],
                       'id': MOCK_DATABASE['List of Albums'][0]['AlbumId']}
         self.assertEqual(self.iphoto.album_data('album1'), album_data)
+
+    def test_photo_count(self):
+        """ Test photo_count """
+        self.assertEqual(self.iphoto.photo_count('album1'),
+                         MOCK_DATABASE['List of Albums'][0]['PhotoCount'])
+
+    def test_read_plist(self):
+        """ Test read_plist """
+        plist = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<plist version="1.0">\n'
+                 '<dict>\n'
+                 '  <key>Album</key><string>album1</string>\n'
+                 '  <key>Empty</key><string></string>\n'
+                 '  <key>Space</key><string> </string>\n'
+                 '  <key>Count</key><integer>2</integer>\n'
+                 '  <key>Seconds</key><real>409106772.65649</real>\n'
+                 '  <!-- a comment -->\n'
+                 '  <key>Flag</key><true/>\n'
+                 '  <key>Blob</key><data>aGVsbG8=</data>\n'
+                 '  <key>When</key><date>2013-12-19T00:46:12Z</date>\n'
+                 '  <key>Images</key>\n'
+                 '  <array>\n'
+                 '    <dict><key>Id</key><integer>1</integer></dict>\n'
+                 '    <array><false/></array>\n'
+                 '  </array>\n'
+                 '</dict>\n'
+                 '</plist>\n')
+        tmpdir = self.mkdtemp()
+        path = os.path.join(tmpdir, 'AlbumData.xml')
+        with open(path, 'w') as plist_file:
+            plist_file.write(plist)
+        expected = {'Album': 'album1',
+                    'Empty': '',
+                    'Space': ' ',
+                    'Count': 2,
+                    'Seconds': 409106772.65649,
+                    'Flag': True,
+                    'Blob': b'hello',
+                    'When': datetime(2013, 12, 19, 0, 46, 12),
+                    'Images': [{'Id': 1}, [False]]}
+        self.assertEqual(read_plist(path), expected)
+        # plistlib fallback
+        with patch.object(iphoto, 'etree', None):
+            self.assertEqual(read_plist(path), expected)
+
+    def test_convert_image_dates(self):
+        """ Test convert_image_dates """
+        images = {'1': {'Caption': 'A normal caption',
+                        'DateAsTimerInterval': 360962921.0,
+                        'MetaModDateAsTimerInterval': 409106772.65649},
+                  '2': {'Caption': 'Another caption',
+                        'DateAsTimerIntervalGMT': 360948521.0,
+                        'ModDateAsTimerInterval': 637691448.4556475}}
+        expected = {'1': {'Caption': 'A normal caption',
+                          'Date': datetime(2012, 6, 9, 19, 28, 41),
+                          'MetaModDate': datetime(2013, 12, 19, 0, 46, 12,
+                                                  656490)},
+                    '2': {'Caption': 'Another caption',
+                          'DateGMT': datetime(2012, 6, 9, 15, 28, 41),
+                          'ModDate': datetime(2021, 3, 17, 16, 30, 48,
+                                              455647)}}
+        self.assertDictEqual(expected, convert_image_dates(images))
+        # numpy path must round exactly like datetime.timedelta
+        self.assertEqual(expected['2']['ModDate'],
+                         convert_timer_interval(637691448.4556475))
+        # Pure-Python path, through the process pool
+        with patch.object(iphoto, 'numpy', None), \
+                patch.object(iphoto, 'PARALLEL_THRESHOLD', 1), \
+                patch.object(iphoto.os, 'cpu_count', return_value=2):
+            self.assertDictEqual(expected, convert_image_dates(images))
+            # A broken pool falls back to converting serially
+            with patch.object(iphoto, 'ProcessPoolExecutor') as pool:
+                pool.side_effect = iphoto.BrokenProcessPool
+                self.assertDictEqual(expected, convert_image_dates(images))
+            # No pool at all with a single CPU
+            with patch.object(iphoto, 'ProcessPoolExecutor') as pool, \
+                    patch.object(iphoto.os, 'cpu_count', return_value=1):
+                self.assertDictEqual(expected, convert_image_dates(images))
+                self.assertFalse(pool.called)
+
+    def test_cache(self):
+        """ Test IPhoto loads from the pickle cache on the second run """
+        tmpdir = self.mkdtemp()
+        open(os.path.join(tmpdir, 'AlbumData.xml'), 'w').close()
+        with patch.object(iphoto, 'read_plist') as mock:
+            mock.return_value = MOCK_DATABASE
+            first = IPhoto(tmpdir)
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         ['AlbumData.xml',
+                          'AlbumData.xml' + iphoto.CACHE_SUFFIX])
+        with patch.object(iphoto, 'read_plist') as mock:
+            second = IPhoto(tmpdir)
+            self.assertFalse(mock.called)
+        self.assertEqual(list(first.photos('album1')),
+                         list(second.photos('album1')))
+        self.assertEqual(first.album_data('album1'),
+                         second.album_data('album1'))
+
+    @patch.object(iphoto, 'read_plist')
+    def test_photos_raw(self, mock):
+        """ Test photos skips RAW photos unless include_raw_photos """
+        raw_image = dict(MOCK_DATABASE['Master Image List']['2'],
+                         OriginalPath='nowhere/obe.nef')
+        mock.return_value = {
+            'List of Albums': MOCK_DATABASE['List of Albums'],
+            'Master Image List': {'1': MOCK_DATABASE['Master Image List']['1'],
+                                  '2': raw_image}}
+        raw_iphoto = IPhoto(use_cache=False)
+        photos = list(raw_iphoto.photos('album1'))
+        self.assertEqual([photo['GUID'] for photo in photos],
+                         [MOCK_DATABASE['Master Image List']['1']['GUID']])
+        # The skipped RAW photo isn't converted
+        with patch.object(iphoto, 'convert_image_dates') as convert:
+            convert.return_value = {}
+            list(raw_iphoto.photos('album1'))
+            self.assertFalse(convert.called)
+        photos = list(raw_iphoto.photos('album1', include_raw_photos=True))
+        self.assertEqual(len(photos), 2)
+
+    def test_write_photos_json(self):
+        """ Test write_photos_json matches json.dump of the whole output """
+        expected = json.dumps({'album1': list(self.iphoto.photos('album1'))},
+                              indent=2, cls=DatetimeEncoder)
+        self.assertIn('"Date": "2013-12-19T00:46:12.656490"', expected)
+        output = io.BytesIO()
+        write_photos_json(self.iphoto, ['album1'], output)
+        self.assertEqual(output.getvalue().decode('utf-8'), expected)
+        # json module fallback
+        with patch.object(iphoto, 'orjson', None):
+            output = io.BytesIO()
+            write_photos_json(self.iphoto, ['album1'], output)
+            self.assertEqual(output.getvalue().decode('utf-8'), expected)
+
+    def test_find_binary_albumdata(self):
+        """ Test find_binary_albumdata only returns a current binary copy """
+        tmpdir = self.mkdtemp()
+        xml_path = os.path.join(tmpdir, 'AlbumData.xml')
+        binary_path = os.path.join(tmpdir, 'AlbumData.plist')
+        self.assertIsNone(find_binary_albumdata(xml_path))
+        open(xml_path, 'w').close()
+        open(binary_path, 'w').close()
+        os.utime(xml_path, (1000, 1000))
+        os.utime(binary_path, (2000, 2000))
+        self.assertEqual(find_binary_albumdata(xml_path), binary_path)
+        # Older than AlbumData.xml, so stale
+        os.utime(binary_path, (500, 500))
+        self.assertIsNone(find_binary_albumdata(xml_path))
+
+    @patch.object(iphoto, 'read_plist')
+    @patch.object(iphoto, 'biplist')
+    def test_binary_albumdata(self, mock_biplist, mock_read_plist):
+        """ Test IPhoto reads a binary AlbumData plist with biplist """
+        mock_biplist.readPlist.return_value = MOCK_DATABASE
+        tmpdir = self.mkdtemp()
+        binary_path = os.path.join(tmpdir, 'AlbumData.binary')
+        open(binary_path, 'w').close()
+        binary_iphoto = IPhoto(tmpdir, use_cache=False)
+        mock_biplist.readPlist.assert_called_once_with(binary_path)
+        self.assertFalse(mock_read_plist.called)
+        self.assertEqual(list(binary_iphoto.albums()), ['album1'])
+
+    @patch.object(iphoto, 'read_plist')
+    def test_cache_unloadable(self, mock):
+        """ Test a cache that can't be unpickled is treated as a miss """
+        mock.return_value = MOCK_DATABASE
+        tmpdir = self.mkdtemp()
+        open(os.path.join(tmpdir, 'AlbumData.xml'), 'w').close()
+        cache_path = os.path.join(tmpdir,
+                                  'AlbumData.xml' + iphoto.CACHE_SUFFIX)
+        # Missing module (ImportError) and missing attribute
+        for cache in (b'cno_such_module\nThing\n.', b'cos\nno_such\n.'):
+            with open(cache_path, 'wb') as cache_file:
+                cache_file.write(cache)
+            cached_iphoto = IPhoto(tmpdir)
+            self.assertEqual(list(cached_iphoto.albums()), ['album1'])
+
+    def test_main_json_text_stdout(self):
+        """ Test main writes JSON to a stdout without a .buffer """
+        stdout = io.StringIO()
+        argv = ['iphoto.py', '-a', 'album1', '-f', 'json']
+        with patch.object(iphoto, 'IPhoto', return_value=self.iphoto), \
+                patch.object(iphoto.sys, 'argv', argv), \
+                patch.object(iphoto.sys, 'stdout', stdout):
+            iphoto.main()
+        expected = json.dumps({'album1': list(self.iphoto.photos('album1'))},
+                              indent=2, cls=DatetimeEncoder)
+        self.assertEqual(stdout.getvalue(), expected)